@@ -22,6 +22,7 @@ MODEL_CONFIG = {
 RECENT_MESSAGE_COUNT = 15           # Keep last 10 messages in full
 SUMMARIZE_THRESHOLD = 15            # Start summarizing after 10 messages
 SUMMARY_MAX_TOKENS = 25000           # Max tokens for summary
+SUMMARY_REFRESH_BUFFER = 5          # Reuse a cached summary until it lags this many messages
 MESSAGE_COMPRESS_THRESHOLD = 25000   # Compress messages longer than this
 MESSAGE_COMPRESSED_SIZE = 25000       # Compress to this size
 TARGET_INPUT_TOKENS = 20000         # Target input size
@@ -43,4 +44,6 @@ Tells the story exactly as it unfolds, without adding speculation or deviating f
 
 Write the summary like a well-formed narrative that feels like a faithful story recap or story-so-far, explaining what has happened, why it happened, how characters reacted, how dynamics evolved, and how the story is progressing toward its next phase."""
 
-COMPRESS_PROMPT = """Summarize the following story segment concisely while preserving key plot points, character actions, and important details. Keep it under 2000 words:"""
\ No newline at end of file
+COMPRESS_PROMPT = """Summarize the following story segment concisely while preserving key plot points, character actions, and important details. Keep it under 2000 words:"""
+
+CONDENSE_PROMPT = """Condense the following story summary so it fits within {max_tokens} tokens. Keep it in flowing prose and preserve all main characters, their current status and relationships, key plot developments, the current setting and situation, and every unresolved thread. Drop repetition and minor detail first:"""
\ No newline at end of file
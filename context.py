@@ -1,44 +1,136 @@
-from typing import List, Dict
+import asyncio
+from functools import lru_cache
+from typing import List, Dict, Optional
 from database import (
-    count_messages,
+    has_more_than,
     get_all_messages,
-    get_last_n_messages,
-    get_messages_range,
-    get_cached_summary,
+    load_context_bundle,
+    get_conversation_text,
     get_latest_cached_summary,
     cache_summary,
     estimate_tokens,
-    get_story_context
+    estimate_conversation_tokens,
+    get_story_context,
+    save_compressed_content
 )
-from llm_utils import generate_summary, compress_message
+from llm_utils import summarize_conversation, compress_message, condense_summary
 from config import (
     RECENT_MESSAGE_COUNT,
     SUMMARY_MAX_TOKENS,
+    SUMMARY_REFRESH_BUFFER,
     MESSAGE_COMPRESS_THRESHOLD,
     MESSAGE_COMPRESSED_SIZE,
     MAX_INPUT_TOKENS,
     STORY_SYSTEM_PROMPT
 )
 
-def compress_if_needed(message: Dict) -> Dict:
-    """Compress a message if it's too long"""
-    token_count = estimate_tokens(message['content'])
+# Built once at import; STORY_SYSTEM_PROMPT never changes at runtime
+_SYSTEM_MESSAGE = {"role": "system", "content": STORY_SYSTEM_PROMPT}
+_STORY_PREFIX = STORY_SYSTEM_PROMPT + "\n\nOriginal story reference:\n"
+_SUMMARY_PREFIX = "Story so far: "
+
+
+def _system_message(story: Optional[str]) -> Dict:
+    """System prompt message, with the pinned story appended if there is one"""
+    if story:
+        return {"role": "system", "content": _STORY_PREFIX + story}
+    return _SYSTEM_MESSAGE
+
+
+@lru_cache(maxsize=None)
+def _prompt_tokens(prompt: str) -> int:
+    """Token count of one of the static prompt strings above, computed once"""
+    return estimate_tokens(prompt)
+
+
+def _sent_tokens(row: Dict, sent: Dict) -> Optional[int]:
+    """Stored token count of a message row, if it is being sent unchanged"""
+    return row['token_count'] if sent['content'] == row['content'] else None
+
+
+def _context_tokens(bundle: Dict, summary: str, summary_tokens: Optional[int],
+                    recent_rows: List[Dict], recent_messages: List[Dict]) -> int:
+    """Estimate total context tokens from stored counts: system prompt, pinned
+    story, summary and unchanged messages are all known without re-tokenizing"""
+    story = bundle["story"]
+    if story:
+        story_tokens = bundle["story_tokens"]
+        if story_tokens is None:
+            story_tokens = estimate_tokens(story)
+        system_tokens = _prompt_tokens(_STORY_PREFIX) + story_tokens
+    else:
+        system_tokens = _prompt_tokens(STORY_SYSTEM_PROMPT)
+    if summary_tokens is None:
+        summary_tokens = estimate_tokens(summary)
+    
+    sized = [
+        {"role": "system", "token_count": system_tokens},
+        {"role": "system", "token_count": _prompt_tokens(_SUMMARY_PREFIX) + summary_tokens}
+    ]
+    sized.extend(
+        {"role": sent['role'], "content": sent['content'], "token_count": _sent_tokens(row, sent)}
+        for row, sent in zip(recent_rows, recent_messages)
+    )
+    return estimate_conversation_tokens(sized)
+
+
+async def compress_if_needed(message: Dict) -> Dict:
+    """Compress a message if it's too long, reusing the stored compression"""
+    if message.get('compressed_content'):
+        return {
+            "role": message['role'],
+            "content": f"[Previous scene, compressed]: {message['compressed_content']}"
+        }
+    
+    # Rows stored with a token count are compared directly, whatever their length
+    token_count = message.get('token_count')
+    if token_count is None:
+        content_length = len(message['content'])
+        
+        # Unknown count: skip clearly short messages and use the cheap
+        # 4-chars-per-token estimate for mid-sized ones, tokenizing only the rest
+        if content_length < MESSAGE_COMPRESS_THRESHOLD * 2:
+            return {"role": message['role'], "content": message['content']}
+        if content_length < MESSAGE_COMPRESS_THRESHOLD * 5:
+            token_count = content_length // 4
+        else:
+            token_count = await asyncio.to_thread(estimate_tokens, message['content'])
     
     if token_count > MESSAGE_COMPRESS_THRESHOLD:
         print(f"🔧 Compressing message: {token_count} tokens → {MESSAGE_COMPRESSED_SIZE} tokens")
-        compressed_content = compress_message(message['content'], MESSAGE_COMPRESSED_SIZE)
+        compressed_content = await compress_message(message['content'], MESSAGE_COMPRESSED_SIZE)
+        
+        if compressed_content is None:
+            # Fallback: truncate for this request only, so a later turn retries
+            compressed_content = message['content'][:MESSAGE_COMPRESSED_SIZE * 4]
+        elif message.get('id') is not None:
+            # Stored so each message is compressed once, not on every turn it stays recent
+            await asyncio.to_thread(save_compressed_content, message['id'], compressed_content)
+        
         return {
             "role": message['role'],
             "content": f"[Previous scene, compressed]: {compressed_content}"
         }
     
-    return message
+    return {"role": message['role'], "content": message['content']}
 
 
-def generate_summary_incremental(session_id: str, target_coverage: int) -> str:
+def is_reusable_summary(latest: Optional[tuple], desired_coverage: int) -> bool:
+    """Check whether a (coverage, summary) pair is within SUMMARY_REFRESH_BUFFER messages of desired_coverage"""
+    return bool(latest) and latest[0] >= desired_coverage - SUMMARY_REFRESH_BUFFER
+
+
+def get_reusable_summary(session_id: str, desired_coverage: int) -> Optional[tuple]:
+    """Get the latest cached summary if it is still close enough to desired_coverage"""
+    latest = get_latest_cached_summary(session_id)
+    
+    return latest if is_reusable_summary(latest, desired_coverage) else None
+
+
+async def generate_summary_incremental(session_id: str, target_coverage: int) -> str:
     """Generate summary incrementally"""
     # Check if we have a previous summary to build on
-    latest = get_latest_cached_summary(session_id)
+    latest = await asyncio.to_thread(get_latest_cached_summary, session_id)
     
     if latest:
         prev_coverage, prev_summary = latest
@@ -48,20 +140,20 @@ def generate_summary_incremental(session_id: str, target_coverage: int) -> str:
             return prev_summary
         
         # Generate incremental summary for new messages
-        new_messages = get_messages_range(session_id, prev_coverage + 1, target_coverage)
+        new_text = await asyncio.to_thread(get_conversation_text, session_id, prev_coverage + 1, target_coverage)
         
-        if new_messages:
+        if new_text:
             print(f"📝 Generating incremental summary for messages {prev_coverage + 1}-{target_coverage}")
-            new_summary_part = generate_summary(new_messages, max_tokens=1000)
+            new_summary_part = await summarize_conversation(new_text, max_tokens=1000)
             
             # Combine summaries
             combined = f"{prev_summary}\n\nRecent developments: {new_summary_part}"
             
-            # If combined is too long, re-summarize
-            if estimate_tokens(combined) > SUMMARY_MAX_TOKENS:
-                print("🔄 Combined summary too long, re-summarizing...")
-                all_messages = get_messages_range(session_id, 1, target_coverage)
-                combined = generate_summary(all_messages, SUMMARY_MAX_TOKENS)
+            # If combined is too long, condense the summary itself rather
+            # than re-reading the whole history
+            if await asyncio.to_thread(estimate_tokens, combined) > SUMMARY_MAX_TOKENS:
+                print("🔄 Combined summary too long, condensing...")
+                combined = await condense_summary(combined, SUMMARY_MAX_TOKENS)
             
             return combined
         else:
@@ -69,73 +161,87 @@ def generate_summary_incremental(session_id: str, target_coverage: int) -> str:
     else:
         # No previous summary, generate from scratch
         print(f"📝 Generating summary for messages 1-{target_coverage}")
-        messages = get_messages_range(session_id, 1, target_coverage)
-        summary = generate_summary(messages, SUMMARY_MAX_TOKENS)
+        conversation_text = await asyncio.to_thread(get_conversation_text, session_id, 1, target_coverage)
+        summary = await summarize_conversation(conversation_text, SUMMARY_MAX_TOKENS)
         return summary
 
 
-def build_context(session_id: str, current_prompt: str) -> List[Dict]:
-    """Build context for the LLM request"""
-    total_messages = count_messages(session_id)
-    
-    print(f"\n📊 Building context: {total_messages} total messages")
-    
+async def build_context(session_id: str, current_prompt: str) -> List[Dict]:
+    """Build context for the LLM request.
+
+    SQLite and tokenizer calls run in worker threads (asyncio.to_thread) so a
+    slow write or a long message can't stall other requests' streams.
+    """
     # PHASE 1: Short conversations - send everything
-    if total_messages <= RECENT_MESSAGE_COUNT:
-        print(f"✅ Short conversation, sending all {total_messages} messages")
-        messages = get_all_messages(session_id)
+    if not await asyncio.to_thread(has_more_than, session_id, RECENT_MESSAGE_COUNT):
+        messages = await asyncio.to_thread(get_all_messages, session_id)
+        print(f"\n📊 Building context: {len(messages)} total messages")
+        print(f"✅ Short conversation, sending all {len(messages)} messages")
 
         # Compress any long messages
-        messages = [compress_if_needed(msg) for msg in messages]
+        messages = await asyncio.gather(*(compress_if_needed(msg) for msg in messages))
 
         # Prepend system prompt with story if available
-        story = get_story_context(session_id)
+        story = await asyncio.to_thread(get_story_context, session_id)
         if story:
-            story_section = f"\n\nOriginal story reference:\n{story}"
-            messages.insert(0, {"role": "system", "content": f"{STORY_SYSTEM_PROMPT}{story_section}"})
+            messages.insert(0, _system_message(story))
 
         return messages
     
     # PHASE 2: Long conversations - summarize old, keep recent
+    # A reused summary can lag by SUMMARY_REFRESH_BUFFER messages, so fetch
+    # enough recent messages to cover that gap along with everything else.
+    bundle = await asyncio.to_thread(load_context_bundle, session_id, RECENT_MESSAGE_COUNT + SUMMARY_REFRESH_BUFFER)
+    total_messages = bundle["total_messages"]
+    print(f"\n📊 Building context: {total_messages} total messages")
+    
     old_message_count = total_messages - RECENT_MESSAGE_COUNT
-    print(f"📦 Long conversation: {old_message_count} old + {RECENT_MESSAGE_COUNT} recent")
     
-    # Get or create summary for old messages
-    summary = get_cached_summary(session_id, old_message_count)
+    # Reuse the latest summary while it lags by at most SUMMARY_REFRESH_BUFFER
+    # messages; the uncovered messages are sent in full instead. This keeps the
+    # summary (and so the prompt prefix) unchanged for several turns.
+    latest = bundle["latest_summary"]
     
-    if not summary:
+    if is_reusable_summary(latest, old_message_count):
+        covered, summary = latest
+        summary_tokens = bundle["summary_tokens"]
+        uncovered = max(total_messages - covered, 0)
+        recent_rows = bundle["recent_messages"][len(bundle["recent_messages"]) - uncovered:]
+        print(f"📦 Long conversation: {covered} old + {len(recent_rows)} recent")
+        print(f"♻️  Using cached summary for {covered} messages")
+        
+        # Compress long recent messages
+        recent_messages = await asyncio.gather(*(compress_if_needed(msg) for msg in recent_rows))
+    else:
+        print(f"📦 Long conversation: {old_message_count} old + {RECENT_MESSAGE_COUNT} recent")
+        recent_rows = bundle["recent_messages"][-RECENT_MESSAGE_COUNT:]
+        
+        # Compress long recent messages concurrently with the new summary
         print(f"🔨 Generating new summary for {old_message_count} messages...")
-        summary = generate_summary_incremental(session_id, old_message_count)
-        cache_summary(session_id, old_message_count, summary)
+        summary, *recent_messages = await asyncio.gather(
+            generate_summary_incremental(session_id, old_message_count),
+            *(compress_if_needed(msg) for msg in recent_rows)
+        )
+        summary_tokens = await asyncio.to_thread(cache_summary, session_id, old_message_count, summary)
         print("✅ Summary cached")
-    else:
-        print(f"♻️  Using cached summary for {old_message_count} messages")
-    
-    # Get recent messages
-    recent_messages = get_last_n_messages(session_id, RECENT_MESSAGE_COUNT)
     
-    # Compress long recent messages
-    recent_messages = [compress_if_needed(msg) for msg in recent_messages]
-    
-    # Build final context
-    story = get_story_context(session_id)
-    story_section = f"\n\nOriginal story reference:\n{story}" if story else ""
-    context = [
-        {"role": "system", "content": f"{STORY_SYSTEM_PROMPT}{story_section}\n\nStory so far: {summary}"}
-    ]
+    # Build final context. The static system prompt and the summary are
+    # separate messages so the long prefix stays byte-identical across turns
+    # and can be served from the provider's prompt cache.
+    summary_message = {"role": "system", "content": _SUMMARY_PREFIX + summary}
+    context = [_system_message(bundle["story"]), summary_message]
     context.extend(recent_messages)
     
-    # Estimate total tokens
-    total_tokens = sum(estimate_tokens(msg['content']) for msg in context)
+    total_tokens = await asyncio.to_thread(
+        _context_tokens, bundle, summary, summary_tokens, recent_rows, recent_messages
+    )
     print(f"📏 Total context tokens: ~{total_tokens}")
     
     # Safety check
     if total_tokens > MAX_INPUT_TOKENS:
         print("⚠️  Context exceeds limit! Applying emergency truncation...")
         # Emergency: keep only last 10 messages + summary
-        context = [
-            {"role": "system", "content": f"{STORY_SYSTEM_PROMPT}\n\nStory so far: {summary}"}
-        ]
+        context = [_SYSTEM_MESSAGE, summary_message]
         context.extend(recent_messages[-10:])
     
     return context
\ No newline at end of file
@@ -1,12 +1,45 @@
 import sqlite3
+import threading
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
 from typing import List, Dict, Optional
 from datetime import datetime
+import tiktoken
 from config import DB_NAME
 
+_local = threading.local()
+
+# Hot-path statements, kept as constants so sqlite3's per-connection
+# statement cache compiles each of them only once
+INSERT_MESSAGE_SQL = '''
+    INSERT INTO messages (session_id, role, content, input_tokens, output_tokens, token_count)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+UPSERT_SUMMARY_SQL = '''
+    INSERT OR REPLACE INTO summaries (session_id, messages_covered, summary_text, summary_tokens)
+    VALUES (?, ?, ?, ?)
+'''
+COUNT_MESSAGES_SQL = 'SELECT COUNT(*) FROM messages WHERE session_id = ?'
+
+
+def get_connection() -> sqlite3.Connection:
+    """Get this thread's shared connection, opening it on first use"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_NAME, timeout=30.0)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA mmap_size=268435456')
+        conn.execute('PRAGMA cache_size=-20000')
+        _local.conn = conn
+    return conn
+
 
 def init_database():
     """Initialize SQLite database"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
+    conn = get_connection()
     cursor = conn.cursor()
     
     # Messages table - stores all messages in full
@@ -18,9 +51,15 @@ def init_database():
             content TEXT NOT NULL,
             input_tokens INTEGER DEFAULT 0,
             output_tokens INTEGER DEFAULT 0,
+            token_count INTEGER,
+            compressed_content TEXT,
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+
+    # Older databases were created before token_count existed
+    _add_column_if_missing(cursor, "messages", "token_count", "INTEGER")
+    _add_column_if_missing(cursor, "messages", "compressed_content", "TEXT")
     
     # Summaries table - caches summaries for old messages
     cursor.execute('''
@@ -28,6 +67,7 @@ def init_database():
             session_id TEXT NOT NULL,
             messages_covered INTEGER NOT NULL,
             summary_text TEXT NOT NULL,
+            summary_tokens INTEGER,
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
             PRIMARY KEY (session_id, messages_covered)
         )
@@ -38,127 +78,257 @@ def init_database():
         CREATE TABLE IF NOT EXISTS story_context (
             session_id TEXT PRIMARY KEY,
             story_text TEXT NOT NULL,
+            story_tokens INTEGER,
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+    
+    _add_column_if_missing(cursor, "summaries", "summary_tokens", "INTEGER")
+    _add_column_if_missing(cursor, "story_context", "story_tokens", "INTEGER")
 
     # Create indexes
-    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_session_timestamp
-                     ON messages(session_id, timestamp DESC)''')
+    # id is monotonic, so it gives insertion order without timestamp ties
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_session_id_desc
+                     ON messages(session_id, id DESC)''')
+    cursor.execute('DROP INDEX IF EXISTS idx_session_timestamp')
     cursor.execute('''CREATE INDEX IF NOT EXISTS idx_summary_session
                      ON summaries(session_id, messages_covered DESC)''')
     
     conn.commit()
-    conn.close()
     print("✅ Database initialized successfully")
 
 
+def _add_column_if_missing(cursor, table: str, column: str, definition: str):
+    """Add a column to an existing table if it isn't there yet"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """Load the tokenizer once per process"""
+    return tiktoken.get_encoding("cl100k_base")
+
+
+# Token counts keyed by an 8-byte content digest, so the cache holds no
+# message bodies. Bounded LRU: oldest entries are evicted first.
+TOKEN_CACHE_SIZE = 4096
+_token_counts = OrderedDict()
+_token_counts_lock = threading.Lock()
+
+
 def estimate_tokens(text: str) -> int:
-    """Estimate token count (roughly 4 chars per token)"""
-    return len(text) // 4
+    """Count tokens with tiktoken (cached, so unchanged messages are free)"""
+    digest = hashlib.blake2b(text.encode(), digest_size=8).digest()
+    
+    with _token_counts_lock:
+        count = _token_counts.get(digest)
+        if count is not None:
+            _token_counts.move_to_end(digest)
+            return count
+    
+    count = len(_get_encoding().encode(text, disallowed_special=()))
+    
+    with _token_counts_lock:
+        _token_counts[digest] = count
+        if len(_token_counts) > TOKEN_CACHE_SIZE:
+            _token_counts.popitem(last=False)
+    
+    return count
+
+
+@lru_cache(maxsize=None)
+def _role_prefix_tokens(role: str) -> int:
+    """Token count of a "role: " prefix plus the blank line between messages"""
+    return len(_get_encoding().encode(f"{role}: ")) + len(_get_encoding().encode("\n\n"))
+
+
+def estimate_conversation_tokens(messages: List[Dict]) -> int:
+    """Count tokens of a "role: content" conversation from per-message counts.
+
+    Uses each message's stored token_count when present and the cached
+    per-content count otherwise, so nothing is re-encoded as one big string.
+    """
+    total = 0
+    for msg in messages:
+        token_count = msg.get('token_count')
+        if token_count is None:
+            token_count = estimate_tokens(msg['content'])
+        total += token_count + _role_prefix_tokens(msg['role'])
+    return total
 
 def store_message_with_usage(session_id: str, role: str, content: str, 
                              input_tokens: int = 0, output_tokens: int = 0):
     """Store message with actual token usage from API"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
+    token_count = estimate_tokens(content)
+    
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute(INSERT_MESSAGE_SQL,
+                   (session_id, role, content, input_tokens, output_tokens, token_count))
+    
+    conn.commit()
+
+def store_messages_bulk(session_id: str, messages: List[tuple]):
+    """Store several messages in one transaction.
+
+    Each entry is (role, content) or (role, content, input_tokens, output_tokens).
+    """
+    rows = []
+    for message in messages:
+        role, content = message[0], message[1]
+        input_tokens, output_tokens = message[2:4] if len(message) >= 4 else (0, 0)
+        rows.append((session_id, role, content, input_tokens, output_tokens, estimate_tokens(content)))
+    
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.executemany(INSERT_MESSAGE_SQL, rows)
+        conn.commit()
+    except Exception:
+        # Don't leave a half-written transaction open on the shared connection
+        conn.rollback()
+        raise
+
+def save_compressed_content(message_id: int, compressed_content: str):
+    """Persist the compressed form of a message so it is only compressed once"""
+    conn = get_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
-        INSERT INTO messages (session_id, role, content, input_tokens, output_tokens)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (session_id, role, content, input_tokens, output_tokens))
+        UPDATE messages SET compressed_content = ? WHERE id = ?
+    ''', (compressed_content, message_id))
     
     conn.commit()
-    conn.close()
+
+
+def _message_row(row) -> Dict:
+    """Turn an (id, role, content, token_count, compressed_content) row into a dict"""
+    return {
+        "id": row[0],
+        "role": row[1],
+        "content": row[2],
+        "token_count": row[3],
+        "compressed_content": row[4]
+    }
+
 
 def count_messages(session_id: str) -> int:
     """Count total messages for a session"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
+    conn = get_connection()
     cursor = conn.cursor()
     
-    cursor.execute('''
-        SELECT COUNT(*) FROM messages WHERE session_id = ?
-    ''', (session_id,))
+    cursor.execute(COUNT_MESSAGES_SQL, (session_id,))
     
     count = cursor.fetchone()[0]
-    conn.close()
     
     return count
 
 
+def has_more_than(session_id: str, n: int) -> bool:
+    """Check whether a session has more than n messages without counting them all"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+        SELECT 1 FROM messages WHERE session_id = ? LIMIT 1 OFFSET ?
+    ''', (session_id, n))
+    
+    return cursor.fetchone() is not None
+
+
 def get_all_messages(session_id: str) -> List[Dict]:
     """Get all messages for a session"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
+    conn = get_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
-        SELECT role, content FROM messages 
+        SELECT id, role, content, token_count, compressed_content FROM messages 
         WHERE session_id = ? 
-        ORDER BY timestamp ASC
+        ORDER BY id ASC
     ''', (session_id,))
     
-    messages = [{"role": row[0], "content": row[1]} for row in cursor.fetchall()]
-    conn.close()
+    messages = [_message_row(row) for row in cursor.fetchall()]
     
     return messages
 
 
-def get_last_n_messages(session_id: str, n: int) -> List[Dict]:
-    """Get last N messages for a session"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
+def load_context_bundle(session_id: str, recent_n: int) -> Dict:
+    """Load everything build_context needs for a long conversation in one query:
+    the last recent_n messages, the latest cached summary, the message count
+    and the pinned story, with token counts for the summary and story"""
+    conn = get_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
-        SELECT role, content FROM messages 
-        WHERE session_id = ? 
-        ORDER BY timestamp DESC 
-        LIMIT ?
-    ''', (session_id, n))
-    
-    messages = [{"role": row[0], "content": row[1]} for row in cursor.fetchall()]
-    conn.close()
-    
-    # Reverse to get chronological order
-    return list(reversed(messages))
+        SELECT 'message', id, role, content, token_count, compressed_content FROM (
+            SELECT id, role, content, token_count, compressed_content FROM messages 
+            WHERE session_id = ? 
+            ORDER BY id DESC 
+            LIMIT ?
+        )
+        UNION ALL
+        SELECT 'summary', messages_covered, NULL, summary_text, summary_tokens, NULL FROM (
+            SELECT messages_covered, summary_text, summary_tokens FROM summaries 
+            WHERE session_id = ? 
+            ORDER BY messages_covered DESC 
+            LIMIT 1
+        )
+        UNION ALL
+        SELECT 'count', COUNT(*), NULL, NULL, NULL, NULL FROM messages WHERE session_id = ?
+        UNION ALL
+        SELECT 'story', NULL, NULL, story_text, story_tokens, NULL FROM story_context WHERE session_id = ?
+    ''', (session_id, recent_n, session_id, session_id, session_id))
+    
+    bundle = {
+        "recent_messages": [],
+        "latest_summary": None,
+        "summary_tokens": None,
+        "total_messages": 0,
+        "story": None,
+        "story_tokens": None
+    }
+    for row in cursor.fetchall():
+        kind = row[0]
+        if kind == 'message':
+            bundle["recent_messages"].append(_message_row(row[1:]))
+        elif kind == 'summary':
+            bundle["latest_summary"] = (row[1], row[3])
+            bundle["summary_tokens"] = row[4]
+        elif kind == 'count':
+            bundle["total_messages"] = row[1]
+        elif kind == 'story':
+            bundle["story"] = row[3]
+            bundle["story_tokens"] = row[4]
+    
+    # UNION ALL doesn't guarantee row order, so sort into chronological order here
+    bundle["recent_messages"].sort(key=lambda msg: msg["id"])
+    
+    return bundle
 
 
-def get_messages_range(session_id: str, start: int, end: int) -> List[Dict]:
-    """Get messages in a range (1-indexed, inclusive)"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
+def get_conversation_text(session_id: str, start: int, end: int) -> str:
+    """Get messages in a range (1-indexed, inclusive) as "role: content" text"""
+    conn = get_connection()
     cursor = conn.cursor()
     
+    # Role prefixes are added by SQLite so Python only has to join the rows
     cursor.execute('''
-        SELECT role, content FROM messages 
+        SELECT role || ': ' || content FROM messages 
         WHERE session_id = ? 
-        ORDER BY timestamp ASC 
+        ORDER BY id ASC 
         LIMIT ? OFFSET ?
     ''', (session_id, end - start + 1, start - 1))
     
-    messages = [{"role": row[0], "content": row[1]} for row in cursor.fetchall()]
-    conn.close()
-    
-    return messages
-
-
-def get_cached_summary(session_id: str, messages_covered: int) -> Optional[str]:
-    """Get cached summary for specific message count"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT summary_text FROM summaries 
-        WHERE session_id = ? AND messages_covered = ?
-    ''', (session_id, messages_covered))
-    
-    result = cursor.fetchone()
-    conn.close()
-    
-    return result[0] if result else None
+    return "\n\n".join(row[0] for row in cursor.fetchall())
 
 
 def get_latest_cached_summary(session_id: str) -> Optional[tuple]:
     """Get the most recent cached summary and its coverage"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
+    conn = get_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -169,32 +339,31 @@ def get_latest_cached_summary(session_id: str) -> Optional[tuple]:
     ''', (session_id,))
     
     result = cursor.fetchone()
-    conn.close()
     
     return result if result else None
 
 
-def cache_summary(session_id: str, messages_covered: int, summary: str):
-    """Cache a summary"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
+def cache_summary(session_id: str, messages_covered: int, summary: str) -> int:
+    """Cache a summary along with its token count, and return that count"""
+    summary_tokens = estimate_tokens(summary)
+    
+    conn = get_connection()
     cursor = conn.cursor()
     
-    cursor.execute('''
-        INSERT OR REPLACE INTO summaries (session_id, messages_covered, summary_text)
-        VALUES (?, ?, ?)
-    ''', (session_id, messages_covered, summary))
+    cursor.execute(UPSERT_SUMMARY_SQL, (session_id, messages_covered, summary, summary_tokens))
     
     conn.commit()
-    conn.close()
+    
+    return summary_tokens
 
 
 def get_session_stats(session_id: str) -> Dict:
     """Get statistics with accurate costs"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
+    conn = get_connection()
     cursor = conn.cursor()
     
     # Total messages
-    cursor.execute('SELECT COUNT(*) FROM messages WHERE session_id = ?', (session_id,))
+    cursor.execute(COUNT_MESSAGES_SQL, (session_id,))
     total_messages = cursor.fetchone()[0]
     
     # Cached summaries
@@ -214,8 +383,6 @@ def get_session_stats(session_id: str) -> Dict:
     total_input = result[0] or 0
     total_output = result[1] or 0
     
-    conn.close()
-    
     return {
         "total_messages": total_messages,
         "cached_summaries": summary_count,
@@ -227,7 +394,7 @@ def get_session_stats(session_id: str) -> Dict:
 
 def delete_session(session_id: str) -> int:
     """Delete a session and all its data"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
+    conn = get_connection()
     cursor = conn.cursor()
     
     cursor.execute('DELETE FROM messages WHERE session_id = ?', (session_id,))
@@ -236,35 +403,35 @@ def delete_session(session_id: str) -> int:
     cursor.execute('DELETE FROM summaries WHERE session_id = ?', (session_id,))
     
     conn.commit()
-    conn.close()
     
     return messages_deleted
 
 def save_story_context(session_id: str, story_text: str):
-    """Save (or replace) the pinned story for a session"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
+    """Save (or replace) the pinned story for a session and return its token count"""
+    story_tokens = estimate_tokens(story_text)
+    
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('''
-        INSERT OR REPLACE INTO story_context (session_id, story_text)
-        VALUES (?, ?)
-    ''', (session_id, story_text))
+        INSERT OR REPLACE INTO story_context (session_id, story_text, story_tokens)
+        VALUES (?, ?, ?)
+    ''', (session_id, story_text, story_tokens))
     conn.commit()
-    conn.close()
+    return story_tokens
 
 
 def get_story_context(session_id: str) -> Optional[str]:
     """Get the pinned story for a session"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT story_text FROM story_context WHERE session_id = ?', (session_id,))
     result = cursor.fetchone()
-    conn.close()
     return result[0] if result else None
 
 
 def get_all_sessions() -> List[Dict]:
     """Get all unique sessions with their message counts and last activity"""
-    conn = sqlite3.connect(DB_NAME, timeout=30.0)
+    conn = get_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -285,5 +452,4 @@ def get_all_sessions() -> List[Dict]:
             "last_activity": row[2]
         })
     
-    conn.close()
     return sessions
\ No newline at end of file
@@ -1,20 +1,29 @@
 import sqlite3
+import sys
 
 DB_NAME = "story_conversations.db"
 
+# Usage: python delete.py [session_id]
+session_id = sys.argv[1] if len(sys.argv) > 1 else None
+
 conn = sqlite3.connect(DB_NAME)
+conn.execute("PRAGMA journal_mode=WAL")
 cursor = conn.cursor()
 
-# Delete last 5 rows from messages table
-cursor.execute('''
-    DELETE FROM messages 
+# Delete last 6 rows from messages table (only from session_id if given)
+session_filter = "WHERE session_id = ?" if session_id else ""
+cursor.execute(f'''
+    DELETE FROM messages
     WHERE id IN (
-        SELECT id FROM messages 
-        ORDER BY timestamp DESC 
+        SELECT id FROM messages
+        {session_filter}
+        ORDER BY id DESC
         LIMIT 6
     )
-''')
+    RETURNING id
+''', (session_id,) if session_id else ())
 
-print(f"Deleted {cursor.rowcount} rows")
+deleted_ids = sorted(row[0] for row in cursor.fetchall())
+print(f"Deleted {len(deleted_ids)} rows: {deleted_ids}")
 conn.commit()
 conn.close()
\ No newline at end of file
@@ -1,16 +1,35 @@
-import requests
+import httpx
 import json
-from typing import List, Dict, Iterator
+from typing import List, Dict, AsyncIterator, Optional
 from config import (
     OPENROUTER_KEY, 
     OPENROUTER_URL, 
     MODEL_CONFIG,
     SUMMARY_PROMPT,
-    COMPRESS_PROMPT
+    COMPRESS_PROMPT,
+    CONDENSE_PROMPT
 )
 
+# Shared client so OpenRouter connections (and TLS sessions) are kept alive
+# across the main, summary and compression calls
+_client = httpx.AsyncClient(
+    http2=True,
+    timeout=120,
+    limits=httpx.Limits(max_keepalive_connections=10),
+    headers={
+        "Authorization": f"Bearer {OPENROUTER_KEY}",
+        "Content-Type": "application/json"
+    }
+)
+
+
 
-def call_llm(messages: List[Dict], max_tokens: int = 4000, temperature: float = 0.8) -> str:
+async def close_client():
+    """Close the shared OpenRouter client (called on app shutdown)"""
+    await _client.aclose()
+
+
+async def call_llm(messages: List[Dict], max_tokens: int = 4000, temperature: float = 0.8) -> str:
     """Call OpenRouter API"""
     payload = {
         "model": MODEL_CONFIG["name"],
@@ -19,13 +38,8 @@ def call_llm(messages: List[Dict], max_tokens: int = 4000, temperature: float =
         "temperature": temperature,
     }
     
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_KEY}",
-        "Content-Type": "application/json"
-    }
-    
     try:
-        r = requests.post(url=OPENROUTER_URL, json=payload, headers=headers, timeout=120)
+        r = await _client.post(OPENROUTER_URL, json=payload)
         r.raise_for_status()
         
         response_data = r.json()
@@ -37,7 +51,7 @@ def call_llm(messages: List[Dict], max_tokens: int = 4000, temperature: float =
         print(f"❌ LLM call failed: {e}")
         raise
 
-def call_llm_stream(messages: List[Dict], max_tokens: int = 4000, temperature: float = 0.8) -> Iterator[str]:
+async def call_llm_stream(messages: List[Dict], max_tokens: int = 4000, temperature: float = 0.8) -> AsyncIterator[str]:
     """Call OpenRouter API with streaming"""
     payload = {
         "model": MODEL_CONFIG["name"],
@@ -48,26 +62,12 @@ def call_llm_stream(messages: List[Dict], max_tokens: int = 4000, temperature: f
         "stream": True  # ← Enable streaming!
     }
     
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_KEY}",
-        "Content-Type": "application/json"
-    }
-    
     try:
-        response = requests.post(
-            url=OPENROUTER_URL, 
-            json=payload, 
-            headers=headers, 
-            stream=True,  # ← Important!
-            timeout=120
-        )
-        response.raise_for_status()
-        
-        # Process streaming response
-        for line in response.iter_lines():
-            if line:
-                line = line.decode('utf-8')
-                
+        async with _client.stream("POST", OPENROUTER_URL, json=payload) as response:
+            response.raise_for_status()
+            
+            # Process streaming response
+            async for line in response.aiter_lines():
                 # OpenRouter sends: "data: {...}"
                 if line.startswith('data: '):
                     data_str = line[6:]  # Remove "data: " prefix
@@ -91,37 +91,47 @@ def call_llm_stream(messages: List[Dict], max_tokens: int = 4000, temperature: f
         print(f"❌ Streaming LLM call failed: {e}")
         raise
 
-def generate_summary(messages: List[Dict], max_tokens: int = 2000) -> str:
-    """Generate summary using LLM"""
-    # Format messages for summary
-    conversation_text = ""
-    for msg in messages:
-        conversation_text += f"{msg['role']}: {msg['content']}\n\n"
-    
+async def summarize_conversation(conversation_text: str, max_tokens: int = 2000) -> str:
+    """Generate summary of already formatted "role: content" conversation text"""
     summary_messages = [
         {"role": "system", "content": SUMMARY_PROMPT},
         {"role": "user", "content": f"Summarize this story conversation:\n\n{conversation_text}"}
     ]
     
     try:
-        summary,_ = call_llm(summary_messages, max_tokens=max_tokens, temperature=0.5)
+        summary,_ = await call_llm(summary_messages, max_tokens=max_tokens, temperature=0.5)
         return summary
     except Exception as e:
         print(f"❌ Summary generation failed: {e}")
         return "Story context available."
 
 
-def compress_message(content: str, target_tokens: int = 800) -> str:
-    """Compress a single long message"""
+async def compress_message(content: str, target_tokens: int = 800) -> Optional[str]:
+    """Compress a single long message (None if the LLM call fails)"""
     compress_messages = [
         {"role": "system", "content": COMPRESS_PROMPT},
         {"role": "user", "content": content}
     ]
     
     try:
-        compressed,_ = call_llm(compress_messages, max_tokens=target_tokens, temperature=0.8)
+        compressed,_ = await call_llm(compress_messages, max_tokens=target_tokens, temperature=0.8)
         return compressed
     except Exception as e:
         print(f"❌ Message compression failed: {e}")
-        # Fallback: truncate
-        return content[:target_tokens * 4]
\ No newline at end of file
+        return None
+
+
+async def condense_summary(summary: str, max_tokens: int = 2000) -> str:
+    """Shorten an existing summary without going back to the raw messages"""
+    condense_messages = [
+        {"role": "system", "content": CONDENSE_PROMPT.format(max_tokens=max_tokens)},
+        {"role": "user", "content": summary}
+    ]
+    
+    try:
+        condensed,_ = await call_llm(condense_messages, max_tokens=max_tokens, temperature=0.5)
+        return condensed
+    except Exception as e:
+        print(f"❌ Summary condensing failed: {e}")
+        # Fallback: keep the uncondensed summary
+        return summary
\ No newline at end of file
@@ -1,16 +1,26 @@
+import asyncio
 import time
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Body
 from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel
 import json
 import uvicorn
 from config import MODEL_CONFIG, MIN_REQUEST_INTERVAL
-from database import init_database, store_message_with_usage, get_session_stats, delete_session, count_messages, get_cached_summary, estimate_tokens, get_all_sessions, save_story_context
-from context import build_context, generate_summary_incremental
-from llm_utils import call_llm
+from database import init_database, store_message_with_usage, store_messages_bulk, get_session_stats, delete_session, count_messages, estimate_tokens, estimate_conversation_tokens, get_all_sessions, save_story_context
+from context import build_context, generate_summary_incremental, get_reusable_summary
+from llm_utils import call_llm, close_client
 import os
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Release pooled OpenRouter connections on shutdown
+    await close_client()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Rate limiting
 last_request_time = 0
@@ -33,7 +43,7 @@ class PromptIn(BaseModel):
 
 
 @app.post("/api/chat")
-def chat(body: PromptIn):
+async def chat(body: PromptIn):
     global last_request_time
     
     # Rate limiting
@@ -51,63 +61,59 @@ def chat(body: PromptIn):
     print(f"📨 New request from session: {body.session_id}")
     print(f"💬 User prompt: {body.prompt[:100]}...")
     
-    # Store user message
-    store_message_with_usage(body.session_id, "user", body.prompt, input_tokens=0, output_tokens=0)
-    
-    # Build context
-    context = build_context(body.session_id, body.prompt)
-    
-    # Add current prompt
-    context.append({"role": "user", "content": body.prompt})
-    
     try:
-        print(f"🚀 Sending request to {body.model}...")
+        # Build context (the user message is stored together with the reply below)
+        context = await build_context(body.session_id, body.prompt)
         
-        # Call LLM
-        assistant_response,usage = call_llm(context, max_tokens=body.max_tokens)
+        # Add current prompt
+        context.append({"role": "user", "content": body.prompt})
         
-        last_request_time = time.time()
-
-        # Extract actual token counts
-        prompt_tokens = usage.get("prompt_tokens", 0)
-        completion_tokens = usage.get("completion_tokens", 0)
-        total_tokens = usage.get("total_tokens", 0)
-        
-        print(f"📊 Tokens - Input: {prompt_tokens}, Output: {completion_tokens}, Total: {total_tokens}")
-        
-        # Store AI response with ACTUAL token count
-        store_message_with_usage(
-            body.session_id, 
-            "assistant", 
-            assistant_response,
-            input_tokens=prompt_tokens,      # ← Real numbers!
-            output_tokens=completion_tokens
-        )
-        
-        print(f"✅ Response generated: {len(assistant_response)} chars")
-        print(f"{'='*60}\n")
+        print(f"🚀 Sending request to {body.model}...")
         
-        return {
-            "choices": [
-                {
-                    "message": {
-                        "role": "assistant",
-                        "content": assistant_response
-                    }
-                }
-            ],
-            "usage": usage  # ← Include usage in response
-        }
+        # Call LLM
+        assistant_response,usage = await call_llm(context, max_tokens=body.max_tokens)
         
     except Exception as e:
         print(f"❌ Error: {e}")
+        # Keep the user's prompt even though no reply was generated
+        await asyncio.to_thread(store_message_with_usage, body.session_id, "user", body.prompt, input_tokens=0, output_tokens=0)
         raise HTTPException(status_code=500, detail=str(e))
+    
+    last_request_time = time.time()
+
+    # Extract actual token counts
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    completion_tokens = usage.get("completion_tokens", 0)
+    total_tokens = usage.get("total_tokens", 0)
+    
+    print(f"📊 Tokens - Input: {prompt_tokens}, Output: {completion_tokens}, Total: {total_tokens}")
+    
+    # Store user prompt and AI response (with ACTUAL token count) in one transaction
+    await asyncio.to_thread(store_messages_bulk, body.session_id, [
+        ("user", body.prompt),
+        ("assistant", assistant_response, prompt_tokens, completion_tokens)  # ← Real numbers!
+    ])
+    
+    print(f"✅ Response generated: {len(assistant_response)} chars")
+    print(f"{'='*60}\n")
+    
+    return {
+        "choices": [
+            {
+                "message": {
+                    "role": "assistant",
+                    "content": assistant_response
+                }
+            }
+        ],
+        "usage": usage  # ← Include usage in response
+    }
 
 
 @app.get("/api/summary/{session_id}")
-def get_summary_endpoint(session_id: str):
+async def get_summary_endpoint(session_id: str):
     """Get current summary for a session"""
-    total_messages = count_messages(session_id)
+    total_messages = await asyncio.to_thread(count_messages, session_id)
     
     if total_messages == 0:
         return {"session_id": session_id, "summary": "No messages yet", "messages": 0}
@@ -122,12 +128,14 @@ def get_summary_endpoint(session_id: str):
         }
     
     old_count = total_messages - RECENT_MESSAGE_COUNT
-    summary = get_cached_summary(session_id, old_count)
+    cached = await asyncio.to_thread(get_reusable_summary, session_id, old_count)
     
-    if not summary:
+    if cached:
+        old_count, summary = cached
+    else:
         from database import cache_summary
-        summary = generate_summary_incremental(session_id, old_count)
-        cache_summary(session_id, old_count, summary)
+        summary = await generate_summary_incremental(session_id, old_count)
+        await asyncio.to_thread(cache_summary, session_id, old_count, summary)
     
     return {
         "session_id": session_id,
@@ -165,8 +173,8 @@ class StoryIn(BaseModel):
 @app.post("/api/set-story/{session_id}")
 def set_story(session_id: str, story: str = Body(..., media_type="text/plain")):
     """Pin a story to a session — injected into every request, never compressed"""
-    save_story_context(session_id, story)
-    return {"session_id": session_id, "story_tokens": estimate_tokens(story)}
+    story_tokens = save_story_context(session_id, story)
+    return {"session_id": session_id, "story_tokens": story_tokens}
 
 
 @app.delete("/api/session/{session_id}")
@@ -197,11 +205,13 @@ async def chat_stream(body: PromptIn):
     print(f"📨 Streaming request from session: {body.session_id}")
     print(f"💬 User prompt: {body.prompt[:100]}...")
     
-    # Store user message
-    store_message_with_usage(body.session_id, "user", body.prompt, input_tokens=0, output_tokens=0)
-    
-    # Build context
-    context = build_context(body.session_id, body.prompt)
+    # Build context (the user message is stored together with the reply below)
+    try:
+        context = await build_context(body.session_id, body.prompt)
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        await asyncio.to_thread(store_message_with_usage, body.session_id, "user", body.prompt, input_tokens=0, output_tokens=0)
+        raise HTTPException(status_code=500, detail=str(e))
     context.append({"role": "user", "content": body.prompt})
     
     # Generator function for streaming
@@ -211,13 +221,14 @@ async def chat_stream(body: PromptIn):
         full_response = ""
         total_input_tokens = 0
         total_output_tokens = 0
+        stored = False
         
         try:
             print(f"🚀 Starting stream to {body.model}...")
             last_request_time = time.time()
             
             # Stream chunks
-            for chunk in call_llm_stream(context, max_tokens=body.max_tokens):
+            async for chunk in call_llm_stream(context, max_tokens=body.max_tokens):
                 full_response += chunk
                 yield f"data: {json.dumps({'content': chunk})}\n\n"
             
@@ -225,10 +236,10 @@ async def chat_stream(body: PromptIn):
             # (OpenRouter doesn't provide usage in streaming mode, so we estimate)
 
             # Estimate input tokens from context
-            total_input_tokens = sum(estimate_tokens(msg['content']) for msg in context)
+            total_input_tokens = await asyncio.to_thread(estimate_conversation_tokens, context)
 
             # Estimate output tokens from response
-            total_output_tokens = estimate_tokens(full_response)
+            total_output_tokens = await asyncio.to_thread(estimate_tokens, full_response)
             
             # Signal completion with token info
             yield "data: " + json.dumps({
@@ -239,14 +250,18 @@ async def chat_stream(body: PromptIn):
                     }
             }) + "\n\n"
             
-            # Store with token usage
-            store_message_with_usage(
-                body.session_id, 
-                "assistant", 
-                full_response,
-                input_tokens=total_input_tokens,
-                output_tokens=total_output_tokens
-            )
+            # Store user prompt and response with token usage in one transaction.
+            # Marked stored up front: if the client disconnects mid-store the worker
+            # thread still finishes it, so the finally block mustn't store again.
+            stored = True
+            try:
+                await asyncio.to_thread(store_messages_bulk, body.session_id, [
+                    ("user", body.prompt),
+                    ("assistant", full_response, total_input_tokens, total_output_tokens)
+                ])
+            except Exception:
+                stored = False
+                raise
             
             print(f"✅ Stream complete: {len(full_response)} chars")
             print(f"📊 Tokens - Input: {total_input_tokens}, Output: {total_output_tokens}")
@@ -254,6 +269,12 @@ async def chat_stream(body: PromptIn):
         except Exception as e:
             print(f"❌ Streaming error: {e}")
             yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            # Keep the user's prompt if the stream failed or the client disconnected.
+            # Deliberately synchronous: after a disconnect the task is cancelled,
+            # and any await here (e.g. asyncio.to_thread) would be cancelled too.
+            if not stored:
+                store_message_with_usage(body.session_id, "user", body.prompt, input_tokens=0, output_tokens=0)
     
     return StreamingResponse(generate(), media_type="text/event-stream")
 